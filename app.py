@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import atexit
+import os
 import sqlite3
 from datetime import datetime
 from pathlib import Path
@@ -12,24 +14,105 @@ import streamlit as st
 # DB helpers
 # ------------------------
 
-def connect(db_path: Path) -> sqlite3.Connection:
-    conn = sqlite3.connect(str(db_path), check_same_thread=False)
+class Connection(sqlite3.Connection):
+    # Plain sqlite3.Connection has no __dict__; the subclass lets us
+    # memoize per-connection probes such as fts_table_exists().
+    pass
+
+def db_file_id(db_path: str) -> int | None:
+    try:
+        return os.stat(db_path).st_ino
+    except OSError:
+        return None
+
+def db_version(db_path: str) -> tuple:
+    """Identity of the db contents, used as part of the result cache keys.
+
+    Covers the file being replaced (inode) and updated in place (mtime),
+    including WAL writes that have not been checkpointed yet.
+    """
+    out = []
+    for p in (db_path, db_path + "-wal"):
+        try:
+            info = os.stat(p)
+            out.append((info.st_ino, info.st_mtime_ns, info.st_size))
+        except OSError:
+            out.append(None)
+    return tuple(out)
+
+def connection_is_current(conn: sqlite3.Connection) -> bool:
+    # `build_index.py --mode rebuild` replaces the db file; drop connections
+    # (and their memoized FTS probes) that still point at the old one.
+    # Not closed here: other sessions may still be mid-query on it. Once the
+    # cache and current_connections drop it, GC releases it.
+    return db_file_id(conn._db_path) == conn._db_ino
+
+# Latest connection per db path, closed by the single atexit hook below.
+current_connections: dict[str, sqlite3.Connection] = {}
+
+@st.cache_resource(validate=connection_is_current)
+def connect(db_path: str) -> sqlite3.Connection:
+    # Cached across Streamlit reruns; keyed on the db path string.
+    conn = sqlite3.connect(db_path, check_same_thread=False, factory=Connection)
+    conn._db_path = db_path
+    conn._db_ino = db_file_id(db_path)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA cache_size=-65536;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA mmap_size=268435456;")
+    has_fts(conn)  # probe once, memoized on the connection
+    current_connections[db_path] = conn
     return conn
 
+def close_connection(conn: sqlite3.Connection):
+    try:
+        conn.execute("PRAGMA optimize;")
+    except sqlite3.Error:
+        pass
+    conn.close()
+
+@atexit.register
+def close_connections():
+    for conn in list(current_connections.values()):
+        close_connection(conn)
+
+def fts_table_exists(conn: sqlite3.Connection, name: str) -> bool:
+    cache = getattr(conn, "_fts_tables", None)
+    if cache is None:
+        cache = {}
+        try:
+            conn._fts_tables = cache
+        except AttributeError:
+            pass
+    if name not in cache:
+        try:
+            row = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type IN ('table','view') AND name=? LIMIT 1",
+                (name,)
+            ).fetchone()
+            cache[name] = row is not None
+        except Exception:
+            cache[name] = False
+    return cache[name]
+
 def has_fts(conn: sqlite3.Connection) -> bool:
+    return fts_table_exists(conn, "tweets_fts")
+
+def has_fts_tri(conn: sqlite3.Connection) -> bool:
+    return fts_table_exists(conn, "tweets_fts_tri")
+
+@st.cache_resource(ttl=300)
+def media_index(media_dir: str) -> set[str]:
+    # Filenames in media_dir, listed once instead of stat-ing per render.
     try:
-        conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='tweets_fts'").fetchone()
-        conn.execute("SELECT count(*) FROM tweets_fts").fetchone()
-        return True
-    except Exception:
-        return False
+        return set(os.listdir(media_dir))
+    except OSError:
+        return set()
 
 def local_path(media_dir: Path | None, filename: str | None) -> Path | None:
     if not media_dir or not filename:
         return None
-    p = media_dir / filename
-    return p if p.exists() else None
+    return media_dir / filename if filename in media_index(str(media_dir)) else None
 
 def fmt_dt(s: str | None) -> str:
     if not s:
@@ -44,7 +127,35 @@ def fmt_dt(s: str | None) -> str:
 # Search
 # ------------------------
 
-def search(conn: sqlite3.Connection, q: str, limit: int, only_media: bool, min_bookmark: int, min_fav: int):
+FTS_OPERATORS = {"AND", "OR", "NOT", "NEAR"}
+
+# bm25 weights for (full_text, screen_name, name); applied via FTS5's rank
+# override so ordering still goes through the rank column.
+FTS_RANK = "bm25(10.0, 2.0, 2.0)"
+
+def fts_tokens(q: str) -> list[str]:
+    words = q.split()
+    # FTS5 operators are case-sensitive; lowercase "not"/"near" are plain words.
+    return [w for w in words if w not in FTS_OPERATORS] or words
+
+def like_escape(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def fts_query(q: str, trigram: bool = False) -> str:
+    """Turn free text into a safe FTS5 MATCH expression (prefix AND of tokens).
+
+    With trigram=True, tokens shorter than 3 characters are dropped since the
+    trigram tokenizer cannot match them; the result may then be empty.
+    """
+    tokens = fts_tokens(q)
+    if trigram:
+        return " ".join('"' + w.replace('"', '""') + '"' for w in tokens if len(w) >= 3)
+    return " ".join('"' + w.replace('"', '""') + '"*' for w in tokens)
+
+def is_cjk(q: str) -> bool:
+    return any("\u4e00" <= c <= "\u9fff" for c in q)
+
+def build_filters(only_media: bool, min_bookmark: int, min_fav: int) -> tuple[list[str], list]:
     filters = []
     params = []
 
@@ -57,24 +168,72 @@ def search(conn: sqlite3.Connection, q: str, limit: int, only_media: bool, min_b
         filters.append("(t.favorite_count IS NOT NULL AND t.favorite_count >= ?)")
         params.append(min_fav)
 
+    return filters, params
+
+def recent(conn: sqlite3.Connection, limit: int, filters: list[str], params: list):
+    # Newest first, served by idx_tweets_created / idx_tweets_hasmedia_created.
     where_extra = (" AND " + " AND ".join(filters)) if filters else ""
+    sql = f"""
+    SELECT t.*
+    FROM tweets t
+    WHERE 1=1 {where_extra}
+    ORDER BY t.created_at_utc DESC
+    LIMIT ?
+    """
+    return conn.execute(sql, params + [limit]).fetchall()
+
+def search(conn: sqlite3.Connection, q: str, limit: int, only_media: bool, min_bookmark: int, min_fav: int,
+           fts_on: bool | None = None):
+    filters, params = build_filters(only_media, min_bookmark, min_fav)
     q = (q or "").strip()
 
+    # no keyword: skip FTS probing and text matching entirely
+    if not q:
+        return recent(conn, limit, filters, params), "recent"
+
     # FTS5 preferred
-    if q and has_fts(conn):
+    if fts_on is None:
+        fts_on = has_fts(conn)
+    fts_table, match, mode = "tweets_fts", fts_query(q), "fts"
+    if fts_on and is_cjk(q) and has_fts_tri(conn):
+        # unicode61 cannot segment CJK text; the trigram index matches terms
+        # of 3+ characters and shorter terms are checked with LIKE.
+        fts_table, match, mode = "tweets_fts_tri", fts_query(q, trigram=True), "trigram"
+        if match:
+            for w in fts_tokens(q):
+                if len(w) < 3:
+                    filters.append(
+                        "(t.full_text LIKE ? ESCAPE '\\' OR t.screen_name LIKE ? ESCAPE '\\'"
+                        " OR t.name LIKE ? ESCAPE '\\')"
+                    )
+                    params.extend([f"%{like_escape(w)}%"] * 3)
+
+    where_extra = (" AND " + " AND ".join(filters)) if filters else ""
+
+    if fts_on and match:
+        # Resolve MATCH in a CTE first so the planner keeps using the FTS index,
+        # then apply column filters. Overfetch when filters may drop hits.
+        inner_limit = limit * 10 if filters else limit
         sql = f"""
+        WITH fts AS (
+            SELECT rowid, rank AS score
+            FROM {fts_table}
+            WHERE {fts_table} MATCH ? AND rank MATCH ?
+            ORDER BY rank
+            LIMIT ?
+        )
         SELECT t.*
-        FROM tweets t
-        JOIN tweets_fts ON tweets_fts.rowid = t.rowid
-        WHERE tweets_fts MATCH ? {where_extra}
-        ORDER BY bm25(tweets_fts) ASC
+        FROM fts
+        JOIN tweets t ON t.rowid = fts.rowid
+        WHERE 1=1 {where_extra}
+        ORDER BY fts.score
         LIMIT ?
         """
-        params2 = [q] + params + [limit]
-        return conn.execute(sql, params2).fetchall(), "fts"
+        params2 = [match, FTS_RANK, inner_limit] + params + [limit]
+        return conn.execute(sql, params2).fetchall(), mode
 
-    # fallback: LIKE
-    like = f"%{q}%" if q else "%"
+    # fallback: LIKE (only when FTS5 is unavailable)
+    like = f"%{q}%"
     sql = f"""
     SELECT t.*
     FROM tweets t
@@ -85,11 +244,40 @@ def search(conn: sqlite3.Connection, q: str, limit: int, only_media: bool, min_b
     params2 = [like, like, like] + params + [limit]
     return conn.execute(sql, params2).fetchall(), "like"
 
-def fetch_media(conn: sqlite3.Connection, tweet_id: str):
-    return conn.execute(
-        "SELECT * FROM media WHERE tweet_id = ? ORDER BY idx ASC",
-        (tweet_id,)
-    ).fetchall()
+SQLITE_MAX_PARAMS = 999
+
+def fetch_media(conn: sqlite3.Connection, tweet_ids: list) -> dict:
+    """Fetch media for many tweets at once, bucketed by tweet_id."""
+    out: dict = {}
+    for i in range(0, len(tweet_ids), SQLITE_MAX_PARAMS):
+        chunk = tweet_ids[i:i + SQLITE_MAX_PARAMS]
+        marks = ",".join("?" * len(chunk))
+        for m in conn.execute(
+            f"SELECT * FROM media WHERE tweet_id IN ({marks}) ORDER BY tweet_id, idx",
+            chunk
+        ):
+            out.setdefault(m["tweet_id"], []).append(m)
+    return out
+
+# sqlite3.Row is not picklable, so the cached wrappers return plain dicts.
+# `version` is db_version(db_path); it only keys the cache so a rebuilt or
+# updated database never serves results computed from the old contents.
+
+@st.cache_data(ttl=60)
+def cached_recent(db_path: str, version: tuple, limit: int):
+    # Unfiltered landing page; short TTL so new imports show up quickly.
+    return [dict(r) for r in recent(connect(db_path), limit, [], [])]
+
+@st.cache_data(ttl=300, max_entries=256)
+def cached_search(db_path: str, version: tuple, q: str, limit: int, only_media: bool, min_bookmark: int, min_fav: int):
+    conn = connect(db_path)
+    rows, mode = search(conn, q, limit, only_media, min_bookmark, min_fav, has_fts(conn))
+    return [dict(r) for r in rows], mode
+
+@st.cache_data(ttl=300, max_entries=256)
+def cached_fetch_media(db_path: str, version: tuple, tweet_ids: tuple):
+    media = fetch_media(connect(db_path), list(tweet_ids))
+    return {tid: [dict(m) for m in ms] for tid, ms in media.items()}
 
 # ------------------------
 # UI i18n
@@ -124,6 +312,10 @@ I18N = {
         "likes": "likes",
         "retweets": "retweets",
         "local_file": "Local file",
+        "show_media": "Play",
+        "page": "Page",
+        "prev_page": "Previous",
+        "next_page": "Next",
     },
     "zh": {
         "page_title": "推特书签检索",
@@ -153,6 +345,10 @@ I18N = {
         "likes": "喜欢",
         "retweets": "转推",
         "local_file": "本地文件",
+        "show_media": "播放",
+        "page": "页",
+        "prev_page": "上一页",
+        "next_page": "下一页",
     }
 }
 
@@ -164,7 +360,7 @@ def t(lang: str, key: str) -> str:
 # Render
 # ------------------------
 
-def render_tweet(conn: sqlite3.Connection, row: sqlite3.Row, media_dir: Path | None, lang: str):
+def render_tweet(row: dict, media_rows: list[dict], media_dir: Path | None, lang: str):
     col1, col2 = st.columns([1, 7])
     with col1:
         p = local_path(media_dir, row["profile_image_file"])
@@ -187,7 +383,6 @@ def render_tweet(conn: sqlite3.Connection, row: sqlite3.Row, media_dir: Path | N
         if row["tweet_url"]:
             st.link_button(t(lang, "open_tweet"), row["tweet_url"])
 
-        media_rows = fetch_media(conn, row["id"])
         if media_rows:
             st.markdown(f"**{t(lang, 'media')}**")
             for m in media_rows:
@@ -197,10 +392,14 @@ def render_tweet(conn: sqlite3.Connection, row: sqlite3.Row, media_dir: Path | N
                 if lf:
                     if mtype in ("photo", "image", "animated_gif"):
                         st.image(str(lf), use_container_width=True)
-                    elif mtype in ("video",):
-                        st.video(str(lf))
-                    elif mtype in ("audio",):
-                        st.audio(str(lf))
+                    elif mtype in ("video", "audio"):
+                        # st.video/st.audio read the whole file; only do it on demand.
+                        key = f'play_{row["id"]}_{m["idx"]}'
+                        if st.toggle(f'{t(lang, "show_media")} ({mtype})', key=key):
+                            if mtype == "video":
+                                st.video(str(lf))
+                            else:
+                                st.audio(str(lf))
                     else:
                         st.caption(f'{t(lang, "local_file")}: {lf.name}')
                 else:
@@ -209,6 +408,11 @@ def render_tweet(conn: sqlite3.Connection, row: sqlite3.Row, media_dir: Path | N
 
     st.divider()
 
+PAGE_SIZE = 10
+
+def set_page(page: int):
+    st.session_state.page = page
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--db", default="bookmarks.db")
@@ -237,7 +441,7 @@ def main():
         st.info(t(lang, "db_not_found_help"))
         st.stop()
 
-    conn = connect(db_path)
+    conn = connect(str(db_path))
     fts_on = has_fts(conn)
 
     with st.sidebar:
@@ -256,11 +460,40 @@ def main():
         else:
             st.write(f'{t(lang, "media_dir")}: {t(lang, "media_dir_not_set")}')
 
-    rows, mode = search(conn, q, limit, only_media, int(min_bookmark), int(min_fav))
-    st.caption(f'{t(lang, "hits")}: {len(rows)}  |  {t(lang, "mode")}: {mode}')
-
-    for r in rows:
-        render_tweet(conn, r, media_dir, lang)
+    version = db_version(str(db_path))
+    if not q.strip() and not (only_media or min_bookmark > 0 or min_fav > 0):
+        rows, mode = cached_recent(str(db_path), version, limit), "recent"
+    else:
+        rows, mode = cached_search(str(db_path), version, q, limit, only_media, int(min_bookmark), int(min_fav))
+    # Reset to the first page whenever the query or filters change.
+    page_sig = (q, limit, only_media, int(min_bookmark), int(min_fav))
+    if st.session_state.get("page_sig") != page_sig:
+        st.session_state.page_sig = page_sig
+        st.session_state.page = 0
+
+    n_pages = max(1, -(-len(rows) // PAGE_SIZE))
+    page = min(st.session_state.page, n_pages - 1)
+    page_rows = rows[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+
+    st.caption(
+        f'{t(lang, "hits")}: {len(rows)}  |  {t(lang, "mode")}: {mode}  |  '
+        f'{t(lang, "page")}: {page + 1}/{n_pages}'
+    )
+
+    # Only the visible page's media is fetched and rendered.
+    media_by_tweet = cached_fetch_media(str(db_path), version, tuple(r["id"] for r in page_rows))
+    with st.container():
+        for r in page_rows:
+            render_tweet(r, media_by_tweet.get(r["id"], []), media_dir, lang)
+
+    if n_pages > 1:
+        prev_col, next_col, _ = st.columns([1, 1, 6])
+        with prev_col:
+            st.button(t(lang, "prev_page"), disabled=page == 0,
+                      on_click=set_page, args=(page - 1,))
+        with next_col:
+            st.button(t(lang, "next_page"), disabled=page >= n_pages - 1,
+                      on_click=set_page, args=(page + 1,))
 
 if __name__ == "__main__":
     main()
@@ -2,13 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import hashlib
 import json
 import os
 import sqlite3
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
 from urllib.parse import urlparse, parse_qs
 
+try:
+    import orjson  # optional, faster JSON parsing
+except ImportError:
+    orjson = None
+
 def parse_dt(dt_str: str) -> str:
     try:
         dt = datetime.fromisoformat(dt_str.replace("Z", "+00:00"))
@@ -18,39 +28,49 @@ def parse_dt(dt_str: str) -> str:
         return dt.replace(tzinfo=timezone.utc).isoformat()
     return dt.astimezone(timezone.utc).isoformat()
 
-def url_to_candidates(url: str) -> list[str]:
-    if not url:
-        return []
+MEDIA_EXTS = ("jpg", "jpeg", "png", "gif", "webp", "mp4", "mov", "m4a", "mp3")
+
+@lru_cache(maxsize=65536)
+def parse_media_url(url: str) -> tuple[str, str]:
+    """Return (basename, format query param) for a media URL."""
     u = urlparse(url)
     base = os.path.basename(u.path).strip()
+    fmt = ""
+    if base and "." not in base:
+        qs = parse_qs(u.query)
+        fmt = (qs.get("format", [""])[0] or "").lower()
+    return base, fmt
+
+def url_to_candidates(url: str) -> Iterator[str]:
+    # Lazy so choose_existing() can stop at the first hit.
+    if not url:
+        return
+    base, fmt = parse_media_url(url)
     if not base:
-        return []
+        return
 
-    candidates = [base]
+    yield base
 
     if "." not in base:
-        qs = parse_qs(u.query)
-        fmt = (qs.get("format", [""])[0] or "").lower()
         if fmt:
-            candidates.append(f"{base}.{fmt}")
+            yield f"{base}.{fmt}"
+        for ext in MEDIA_EXTS:
+            if ext != fmt:
+                yield f"{base}.{ext}"
 
-        for ext in ("jpg", "jpeg", "png", "gif", "webp", "mp4", "mov", "m4a", "mp3"):
-            candidates.append(f"{base}.{ext}")
+def list_media_files(media_dir: Path) -> set[str]:
+    # One directory listing up front; lookups are then set membership tests.
+    return set(os.listdir(media_dir))
 
-    seen = set()
-    out = []
-    for c in candidates:
-        if c not in seen:
-            out.append(c)
-            seen.add(c)
-    return out
+def choose_existing(files_set: set[str], candidates: Iterable[str]) -> str | None:
+    return next((c for c in candidates if c in files_set), None)
 
-def choose_existing(media_dir: Path, candidates: list[str]) -> str | None:
-    for c in candidates:
-        p = media_dir / c
-        if p.exists():
-            return c
-    return None
+def make_profile_resolver(files_set: set[str]) -> Callable[[str], str | None]:
+    # Many tweets share an author, so resolve each profile image URL once.
+    @lru_cache(maxsize=None)
+    def resolve(url: str) -> str | None:
+        return choose_existing(files_set, url_to_candidates(url))
+    return resolve
 
 def ensure_fts5(conn: sqlite3.Connection) -> bool:
     try:
@@ -66,11 +86,30 @@ def get_int(x):
     except Exception:
         return None
 
+INT64_MAX = 2**63 - 1
+
+def tweet_key(raw, integer_ids: bool = True) -> int | str | None:
+    """Integer primary key for a tweet id (a rowid alias in SQLite).
+
+    Twitter ids are 64-bit integers; anything else is mapped to a stable
+    negative hash so it cannot collide with a real id. Databases built
+    before ids were integers keep the stripped string (integer_ids=False)
+    so dedup against their existing rows still works.
+    """
+    tid = str(raw).strip()
+    if not tid:
+        return None
+    if not integer_ids:
+        return tid
+    if tid.isdigit() and int(tid) <= INT64_MAX:
+        return int(tid)
+    digest = hashlib.blake2b(tid.encode("utf-8"), digest_size=8).digest()
+    return -(int.from_bytes(digest, "big") >> 1) - 1
+
 SCHEMA_SQL = """
 CREATE TABLE IF NOT EXISTS tweets (
-    id TEXT PRIMARY KEY,
+    id INTEGER PRIMARY KEY,
     created_at_utc TEXT,
-    created_at_raw TEXT,
     full_text TEXT,
     screen_name TEXT,
     name TEXT,
@@ -88,16 +127,22 @@ CREATE TABLE IF NOT EXISTS tweets (
 );
 
 CREATE TABLE IF NOT EXISTS media (
-    tweet_id TEXT,
+    tweet_id INTEGER,
     idx INTEGER,
     type TEXT,
     url TEXT,
     thumbnail_url TEXT,
     original_url TEXT,
     local_file TEXT,
-    PRIMARY KEY (tweet_id, idx)
+    PRIMARY KEY (tweet_id, idx),
+    FOREIGN KEY (tweet_id) REFERENCES tweets(id)
 );
 
+CREATE INDEX IF NOT EXISTS idx_tweets_created ON tweets(created_at_utc DESC);
+CREATE INDEX IF NOT EXISTS idx_tweets_hasmedia_created ON tweets(has_media, created_at_utc DESC);
+CREATE INDEX IF NOT EXISTS idx_tweets_bookmark ON tweets(bookmark_count);
+CREATE INDEX IF NOT EXISTS idx_tweets_fav ON tweets(favorite_count);
+
 CREATE TABLE IF NOT EXISTS imports (
     file_path TEXT PRIMARY KEY,
     file_size INTEGER,
@@ -106,34 +151,82 @@ CREATE TABLE IF NOT EXISTS imports (
 );
 """
 
-def ensure_fts_tables(conn: sqlite3.Connection) -> bool:
+# The trigram tokenizer (SQLite 3.34+) indexes CJK text, which unicode61
+# would otherwise treat as one long token per run of characters.
+TRIGRAM_OK = sqlite3.sqlite_version_info >= (3, 34, 0)
+
+def fts_indexes() -> list[tuple[str, str]]:
+    # (fts table, trigger name prefix) pairs kept in sync with tweets.
+    out = [("tweets_fts", "tweets")]
+    if TRIGRAM_OK:
+        out.append(("tweets_fts_tri", "tweets_tri"))
+    return out
+
+FTS_TRIGGERS_SQL = """
+CREATE TRIGGER IF NOT EXISTS {prefix}_ai AFTER INSERT ON tweets BEGIN
+    INSERT INTO {fts}(rowid, full_text, screen_name, name)
+    VALUES (new.rowid, new.full_text, new.screen_name, new.name);
+END;
+
+CREATE TRIGGER IF NOT EXISTS {prefix}_ad AFTER DELETE ON tweets BEGIN
+    INSERT INTO {fts}({fts}, rowid, full_text, screen_name, name)
+    VALUES ('delete', old.rowid, old.full_text, old.screen_name, old.name);
+END;
+
+CREATE TRIGGER IF NOT EXISTS {prefix}_au AFTER UPDATE ON tweets BEGIN
+    INSERT INTO {fts}({fts}, rowid, full_text, screen_name, name)
+    VALUES ('delete', old.rowid, old.full_text, old.screen_name, old.name);
+    INSERT INTO {fts}(rowid, full_text, screen_name, name)
+    VALUES (new.rowid, new.full_text, new.screen_name, new.name);
+END;
+"""
+
+def ensure_fts_tables(conn: sqlite3.Connection, with_triggers: bool = True) -> bool:
     if not ensure_fts5(conn):
         return False
 
-    conn.execute("""
+    # remove_diacritics 2 needs SQLite 3.27+; 1 is the older equivalent.
+    diacritics = 2 if sqlite3.sqlite_version_info >= (3, 27, 0) else 1
+    conn.execute(f"""
     CREATE VIRTUAL TABLE IF NOT EXISTS tweets_fts
-    USING fts5(full_text, screen_name, name, content='tweets', content_rowid='rowid');
+    USING fts5(full_text, screen_name, name, content='tweets', content_rowid='rowid',
+               prefix='2 3 4', tokenize='unicode61 remove_diacritics {diacritics}');
     """)
 
-    conn.executescript("""
-    CREATE TRIGGER IF NOT EXISTS tweets_ai AFTER INSERT ON tweets BEGIN
-        INSERT INTO tweets_fts(rowid, full_text, screen_name, name)
-        VALUES (new.rowid, new.full_text, new.screen_name, new.name);
-    END;
-
-    CREATE TRIGGER IF NOT EXISTS tweets_ad AFTER DELETE ON tweets BEGIN
-        INSERT INTO tweets_fts(tweets_fts, rowid, full_text, screen_name, name)
-        VALUES ('delete', old.rowid, old.full_text, old.screen_name, old.name);
-    END;
-
-    CREATE TRIGGER IF NOT EXISTS tweets_au AFTER UPDATE ON tweets BEGIN
-        INSERT INTO tweets_fts(tweets_fts, rowid, full_text, screen_name, name)
-        VALUES ('delete', old.rowid, old.full_text, old.screen_name, old.name);
-        INSERT INTO tweets_fts(rowid, full_text, screen_name, name)
-        VALUES (new.rowid, new.full_text, new.screen_name, new.name);
-    END;
-    """)
+    if TRIGRAM_OK:
+        is_new = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='tweets_fts_tri'"
+        ).fetchone() is None
+        conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS tweets_fts_tri
+        USING fts5(full_text, screen_name, name, content='tweets', content_rowid='rowid',
+                   tokenize='trigram');
+        """)
+        if is_new and with_triggers:
+            # Databases built before the trigram index existed: backfill it.
+            conn.execute("INSERT INTO tweets_fts_tri(tweets_fts_tri) VALUES('rebuild');")
+            conn.commit()
+
+    if with_triggers:
+        ensure_fts_triggers(conn)
+
+    return True
 
+def ensure_fts_triggers(conn: sqlite3.Connection):
+    for fts, prefix in fts_indexes():
+        conn.executescript(FTS_TRIGGERS_SQL.format(fts=fts, prefix=prefix))
+
+def rebuild_fts(conn: sqlite3.Connection):
+    # Rebuild the external-content indexes from tweets in one bulk pass each.
+    for fts, _ in fts_indexes():
+        conn.execute(f"INSERT INTO {fts}({fts}) VALUES('rebuild');")
+    conn.commit()
+
+def integer_ids_schema(conn: sqlite3.Connection) -> bool:
+    # False for databases created before tweets.id became INTEGER PRIMARY KEY.
+    for _, name, col_type, _, _, pk in conn.execute("PRAGMA table_info(tweets)"):
+        if name == "id":
+            return col_type.upper() == "INTEGER" and pk == 1
     return True
 
 def should_skip_file(conn: sqlite3.Connection, file_path: Path) -> bool:
@@ -154,92 +247,147 @@ def mark_file_imported(conn: sqlite3.Connection, file_path: Path):
         (str(file_path), int(st.st_size), float(st.st_mtime), now)
     )
 
-def import_one_json(conn: sqlite3.Connection, json_path: Path, media_dir: Path | None) -> tuple[int, int]:
-    with json_path.open("r", encoding="utf-8") as f:
-        tweets = json.load(f)
+BATCH_SIZE = 1000
+
+TWEET_INSERT_SQL = """INSERT OR IGNORE INTO tweets (
+    id, created_at_utc, full_text, screen_name, name,
+    profile_image_url, profile_image_file, tweet_url,
+    favorite_count, retweet_count, bookmark_count, quote_count, reply_count, views_count,
+    in_reply_to, has_media
+) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"""
+
+MEDIA_INSERT_SQL = """INSERT OR IGNORE INTO media
+(tweet_id, idx, type, url, thumbnail_url, original_url, local_file)
+VALUES (?,?,?,?,?,?,?)"""
+
+def load_tweets(json_path: Path) -> list:
+    if orjson is not None:
+        tweets = orjson.loads(json_path.read_bytes())
+    else:
+        with json_path.open("r", encoding="utf-8") as f:
+            tweets = json.load(f)
 
     if not isinstance(tweets, list):
         raise ValueError(f"JSON root must be list[dict]. File: {json_path}")
-
-    inserted = 0
-    total = 0
+    return tweets
+
+def build_rows(tweets: list, files_set: set[str] | None,
+               resolve_profile: Callable[[str], str | None] | None = None,
+               integer_ids: bool = True) -> tuple[list[tuple], list[tuple]]:
+    """Map exported tweets to (tweet_rows, media_rows) insert tuples in one pass."""
+    if files_set and resolve_profile is None:
+        resolve_profile = make_profile_resolver(files_set)
+    tweet_rows: list[tuple] = []
+    media_rows: list[tuple] = []
+    add_tweet = tweet_rows.append
+    add_media = media_rows.append
 
     for tw in tweets:
-        total += 1
-        tid = str(tw.get("id", "")).strip()
-        if not tid:
+        get = tw.get
+        tid = tweet_key(get("id", ""), integer_ids)
+        if tid is None:
             continue
 
-        # Dedup by tweet id
-        cur = conn.execute("SELECT 1 FROM tweets WHERE id = ? LIMIT 1", (tid,)).fetchone()
-        if cur:
-            continue
-
-        created_raw = tw.get("created_at") or ""
-        created_utc = parse_dt(created_raw) if created_raw else None
-
-        full_text = tw.get("full_text") or ""
-        screen_name = tw.get("screen_name") or ""
-        name = tw.get("name") or ""
-        profile_image_url = tw.get("profile_image_url") or ""
-        tweet_url = tw.get("url") or ""
-
-        in_reply_to = tw.get("in_reply_to")
-        in_reply_to = str(in_reply_to) if in_reply_to is not None else None
-
-        media_list = tw.get("media") or []
-        has_media = 1 if media_list else 0
+        created_raw = get("created_at") or ""
+        profile_image_url = get("profile_image_url") or ""
+        in_reply_to = get("in_reply_to")
+        media_list = get("media") or []
 
         profile_file = None
-        if media_dir and profile_image_url:
-            cand = url_to_candidates(profile_image_url)
-            profile_file = choose_existing(media_dir, cand)
-
-        conn.execute(
-            """INSERT INTO tweets (
-                id, created_at_utc, created_at_raw, full_text, screen_name, name,
-                profile_image_url, profile_image_file, tweet_url,
-                favorite_count, retweet_count, bookmark_count, quote_count, reply_count, views_count,
-                in_reply_to, has_media
-            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-            (
-                tid, created_utc, created_raw, full_text, screen_name, name,
-                profile_image_url, profile_file, tweet_url,
-                get_int(tw.get("favorite_count")),
-                get_int(tw.get("retweet_count")),
-                get_int(tw.get("bookmark_count")),
-                get_int(tw.get("quote_count")),
-                get_int(tw.get("reply_count")),
-                get_int(tw.get("views_count")),
-                in_reply_to, has_media
-            )
-        )
-        inserted += 1
+        if files_set and profile_image_url:
+            profile_file = resolve_profile(profile_image_url)
+
+        add_tweet((
+            tid,
+            parse_dt(created_raw) if created_raw else None,
+            get("full_text") or "",
+            get("screen_name") or "",
+            get("name") or "",
+            profile_image_url, profile_file,
+            get("url") or "",
+            get_int(get("favorite_count")),
+            get_int(get("retweet_count")),
+            get_int(get("bookmark_count")),
+            get_int(get("quote_count")),
+            get_int(get("reply_count")),
+            get_int(get("views_count")),
+            str(in_reply_to) if in_reply_to is not None else None,
+            1 if media_list else 0,
+        ))
 
         for i, m in enumerate(media_list):
-            mtype = m.get("type") or ""
-            url = m.get("url") or ""
-            thumb = m.get("thumbnail") or ""
-            orig = m.get("original") or ""
+            mget = m.get
+            url = mget("url") or ""
+            thumb = mget("thumbnail") or ""
+            orig = mget("original") or ""
 
             local_file = None
-            if media_dir:
+            if files_set:
                 for candidate_url in (orig, thumb, url):
                     if not candidate_url:
                         continue
-                    cand = url_to_candidates(candidate_url)
-                    local_file = choose_existing(media_dir, cand)
+                    local_file = choose_existing(files_set, url_to_candidates(candidate_url))
                     if local_file:
                         break
 
-            conn.execute(
-                """INSERT OR REPLACE INTO media
-                (tweet_id, idx, type, url, thumbnail_url, original_url, local_file)
-                VALUES (?,?,?,?,?,?,?)""",
-                (tid, i, mtype, url, thumb, orig, local_file)
-            )
+            add_media((tid, i, mget("type") or "", url, thumb, orig, local_file))
 
-    return inserted, total
+    return tweet_rows, media_rows
+
+def insert_rows(conn: sqlite3.Connection, tweet_rows: list[tuple], media_rows: list[tuple]) -> int:
+    inserted = 0
+    for i in range(0, len(tweet_rows), BATCH_SIZE):
+        # Dedup by tweet id: OR IGNORE on the primary key; rowcount
+        # counts only rows actually inserted (trigger writes excluded).
+        inserted += conn.executemany(TWEET_INSERT_SQL, tweet_rows[i:i + BATCH_SIZE]).rowcount
+    for i in range(0, len(media_rows), BATCH_SIZE):
+        conn.executemany(MEDIA_INSERT_SQL, media_rows[i:i + BATCH_SIZE])
+    return inserted
+
+# Set once per worker process by init_worker(), so the (possibly large)
+# media filename set is pickled once per worker rather than once per file.
+worker_files_set: set[str] | None = None
+worker_integer_ids = True
+worker_resolve_profile: Callable[[str], str | None] | None = None
+
+def init_worker(files_set: set[str] | None, integer_ids: bool = True):
+    global worker_files_set, worker_resolve_profile, worker_integer_ids
+    worker_files_set = files_set
+    worker_integer_ids = integer_ids
+    # Shared across every file this worker parses.
+    worker_resolve_profile = make_profile_resolver(files_set) if files_set else None
+
+def parse_json_file(json_path: Path) -> tuple[list[tuple], list[tuple], int]:
+    tweets = load_tweets(json_path)
+    tweet_rows, media_rows = build_rows(tweets, worker_files_set, worker_resolve_profile, worker_integer_ids)
+    return tweet_rows, media_rows, len(tweets)
+
+def parse_json_files(json_files: list[Path], files_set: set[str] | None, workers: int,
+                     integer_ids: bool = True) -> Iterator:
+    """Yield (json_path, tweet_rows, media_rows, total) in input order.
+
+    Parsing runs in a process pool; at most 2 * workers files are in flight
+    so parsed rows do not pile up ahead of the single SQLite writer.
+    """
+    if workers <= 1 or len(json_files) <= 1:
+        init_worker(files_set, integer_ids)
+        for jf in json_files:
+            yield (jf, *parse_json_file(jf))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(files_set, integer_ids)) as ex:
+        pending = deque()
+        it = iter(json_files)
+        for jf in it:
+            pending.append((jf, ex.submit(parse_json_file, jf)))
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            jf, fut = pending.popleft()
+            yield (jf, *fut.result())
+            nxt = next(it, None)
+            if nxt is not None:
+                pending.append((nxt, ex.submit(parse_json_file, nxt)))
 
 def collect_json_files(json_path: str, json_dir: str) -> list[Path]:
     files: list[Path] = []
@@ -269,12 +417,14 @@ def main():
     ap.add_argument("--json_dir", default="", help="directory containing *.json")
     ap.add_argument("--db", default="bookmarks.db", help="output SQLite db path")
     ap.add_argument("--media_dir", default="", help="tweet_back directory (optional)")
+    ap.add_argument("--workers", type=int, default=0, help="JSON parser processes (default: CPU count)")
     args = ap.parse_args()
 
     db_path = Path(args.db).expanduser().resolve()
     media_dir = Path(args.media_dir).expanduser().resolve() if args.media_dir else None
     if media_dir and not media_dir.exists():
         raise FileNotFoundError(f"media_dir not found: {media_dir}")
+    files_set = list_media_files(media_dir) if media_dir else None
 
     json_files = collect_json_files(args.json, args.json_dir)
 
@@ -282,16 +432,29 @@ def main():
         db_path.unlink()
 
     conn = sqlite3.connect(str(db_path))
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA synchronous=NORMAL;")
+    if args.mode == "rebuild":
+        # The db is recreated from JSON, so a crash mid-import is recovered by
+        # simply rerunning; skip journaling and fsyncs for bulk load speed.
+        conn.execute("PRAGMA journal_mode=OFF;")
+        conn.execute("PRAGMA synchronous=OFF;")
+    else:
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA cache_size=-262144;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA mmap_size=1073741824;")
     conn.executescript(SCHEMA_SQL)
 
-    fts_ok = ensure_fts_tables(conn)
+    # On rebuild, skip the per-row sync triggers during import and build the
+    # FTS index in bulk afterwards.
+    bulk_fts = args.mode == "rebuild"
+    fts_ok = ensure_fts_tables(conn, with_triggers=not bulk_fts)
 
     new_total = 0
     processed_total = 0
     skipped_files = 0
 
+    to_import = []
     for jf in json_files:
         if not jf.exists():
             raise FileNotFoundError(f"JSON not found: {jf}")
@@ -299,13 +462,31 @@ def main():
         if args.mode == "incremental" and should_skip_file(conn, jf):
             skipped_files += 1
             continue
-
-        inserted, total = import_one_json(conn, jf, media_dir)
+        to_import.append(jf)
+
+    # Parse in parallel, write from this process only (SQLite has one writer).
+    # Never start more processes than there are files to parse.
+    workers = min(args.workers or os.cpu_count() or 1, len(to_import))
+    for jf, tweet_rows, media_rows, total in parse_json_files(to_import, files_set, workers, integer_ids_schema(conn)):
+        # One transaction per file: rows, media and the imports record.
+        with conn:
+            inserted = insert_rows(conn, tweet_rows, media_rows)
+            mark_file_imported(conn, jf)
         new_total += inserted
         processed_total += total
-        mark_file_imported(conn, jf)
-        conn.commit()
 
+    if fts_ok and bulk_fts:
+        rebuild_fts(conn)
+        ensure_fts_triggers(conn)
+
+    if args.mode == "rebuild":
+        # Leave the db in persistent WAL mode so the app can read during imports.
+        conn.execute("PRAGMA journal_mode=WAL;")
+
+    # Refresh planner statistics so FTS/filter queries keep index-using plans.
+    conn.execute("ANALYZE;")
+    conn.execute("PRAGMA optimize;")
+    conn.commit()
     conn.close()
 
     print(f"DB: {db_path}")